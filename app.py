@@ -1,5 +1,6 @@
-from fastapi import FastAPI
+from fastapi import BackgroundTasks, FastAPI
 from solara.server.fastapi import app as solara_app
+from utils.llm_scheduler import llm_scheduler
 
 app = FastAPI()
 
@@ -9,4 +10,21 @@ def read_root():
     return {"message": "test"}
 
 
+@app.get("/metrics/llm")
+def read_llm_metrics():
+    return llm_scheduler.metrics()
+
+
+@app.post("/vanna/train")
+def start_vanna_training(background_tasks: BackgroundTasks):
+    # Imported here, as connecting Vanna to the databases is only needed for training
+    from utils.vanna_train import train_vanna, training_lock
+
+    if training_lock.locked():
+        return {"message": "training is already running"}
+
+    background_tasks.add_task(train_vanna)
+    return {"message": "training started"}
+
+
 app.mount("/solara/", app=solara_app)
@@ -1,21 +1,51 @@
+import uuid
+import asyncio
+import datetime
 import solara
 import solara.lab
 import pandas as pd
-from typing import List
+import plotly.graph_objects as go
+from typing import List, Optional
 from functools import partial
+from urllib.parse import parse_qs
 from typing_extensions import TypedDict
 from utils.vanna_client import vn
 from utils.llm import find_sql
+from utils.charts import create_figure
+from utils.archive import archive
+
+# Number of messages loaded when a session is reopened
+RECENT_MESSAGES = 20
+
+# Number of older messages loaded per click on "load older messages"
+OLDER_MESSAGES_PAGE = 20
+
+# Older messages are dropped from memory, but stay in the archive
+MAX_MESSAGES_IN_MEMORY = 50
+
+# Number of most recent results kept in memory, older ones are read again on request
+RESULTS_IN_MEMORY = 5
+
+# Number of conversations offered in the conversation selector
+SESSIONS_LISTED = 20
 
 class MessageDict(TypedDict):
     role: str  # "user" or "assistant"
     content: str
     dataframe: pd.DataFrame
+    figure: go.Figure
+    figure_checked: bool  # True once a chart was created, or found not to apply
+    sql: Optional[str]  # the SQL query that produced the dataframe
     is_sql_statement: bool
     is_end_of_stream: bool
+    seq: int  # sequence number in the archive
+    result_id: Optional[str]  # id of the archived dataframe
 
 
 messages: solara.Reactive[List[MessageDict]] = solara.reactive([])
+session_id: solara.Reactive[Optional[str]] = solara.reactive(None)
+has_older_messages: solara.Reactive[bool] = solara.reactive(False)
+sessions: solara.Reactive[List[tuple]] = solara.reactive([])
 
 
 def store_feedback(reaction, user_input, chatbot_answer):
@@ -34,7 +64,240 @@ def store_feedback(reaction, user_input, chatbot_answer):
     print(reaction, user_input, chatbot_answer)
 
 
-def create_assistant_message(content="", dataframe=None):
+def archive_message(session, message):
+    """
+    Append a message to the conversation archive. Blocks on disk I/O, so
+    async tasks run it in a worker thread.
+
+    Parameters
+    ----------
+    session : str
+        The id of the conversation the message belongs to.
+    message : MessageDict
+        The message to archive.
+
+    Returns
+    -------
+    MessageDict
+        A copy of the message with its archive "seq" and "result_id" set.
+    """
+    seq, result_id = archive.append_message(session, message)
+    return {**message, "seq": seq, "result_id": result_id}
+
+
+def replace_message(seq, **changes):
+    """
+    Update the fields of the message with the given archive sequence number.
+
+    Parameters
+    ----------
+    seq : int
+        The archive sequence number of the message.
+    **changes
+        The message fields to update.
+    """
+    messages.value = [
+        {**item, **changes} if item.get("seq") == seq else item
+        for item in messages.value
+    ]
+
+
+def trim_messages():
+    """
+    Drop the oldest messages from memory once there are more than
+    `MAX_MESSAGES_IN_MEMORY`. They can be loaded again from the archive.
+    """
+    if len(messages.value) > MAX_MESSAGES_IN_MEMORY:
+        messages.value = messages.value[-MAX_MESSAGES_IN_MEMORY:]
+        has_older_messages.value = True
+
+
+def trim_results(keep_seq=None):
+    """
+    Keep the DataFrames and charts of only the `RESULTS_IN_MEMORY` most
+    recent archived results in memory. Older messages keep their "result_id",
+    so their results can be loaded again with `load_archived_result`.
+
+    Parameters
+    ----------
+    keep_seq : int, optional
+        The sequence number of a message whose result was just loaded and
+        is kept in any case (default is None).
+    """
+    loaded = [
+        item["seq"] for item in messages.value
+        if item.get("dataframe", None) is not None
+        and item.get("result_id", None) is not None
+        and item["seq"] != keep_seq
+    ]
+    limit = RESULTS_IN_MEMORY - 1 if keep_seq is not None else RESULTS_IN_MEMORY
+    dropped = set(loaded[:max(0, len(loaded) - limit)])
+    if dropped:
+        messages.value = [
+            {**item, "dataframe": None, "figure": None, "figure_checked": False}
+            if item.get("seq") in dropped else item
+            for item in messages.value
+        ]
+
+
+def refresh_sessions():
+    """
+    Reload the list of archived conversations shown in the selector.
+    """
+    sessions.value = archive.list_sessions(limit=SESSIONS_LISTED)
+
+
+def load_session(requested_session_id):
+    """
+    Open a conversation, loading its most recent messages from the archive
+    and the results of the latest `RESULTS_IN_MEMORY` of them. Their charts
+    are rebuilt by the `render_figures` task.
+
+    Parameters
+    ----------
+    requested_session_id : str
+        The id of the conversation to open.
+    """
+    session_id.value = requested_session_id
+    recent = archive.load_messages(requested_session_id, limit=RECENT_MESSAGES, load_results=False)
+    with_results = [item for item in recent if item["result_id"] is not None]
+    for item in with_results[-RESULTS_IN_MEMORY:]:
+        item["dataframe"] = archive.load_result(item["result_id"])
+    messages.value = recent
+    has_older_messages.value = bool(recent) and archive.has_older_messages(
+        requested_session_id, recent[0]["seq"]
+    )
+    refresh_sessions()
+    render_figures()
+
+
+def delete_conversation(router):
+    """
+    Delete the open conversation from the archive and start a new one.
+
+    Parameters
+    ----------
+    router : solara.Router
+        The router used to open the new conversation.
+    """
+    archive.delete_session(session_id.value)
+    session_id.value = None
+    messages.value = []
+    router.push(f"{router.path}?session={uuid.uuid4().hex}")
+
+
+def load_older_messages():
+    """
+    Prepend a page of older messages from the archive. Their results are not
+    read until requested with `load_archived_result`.
+    """
+    before_seq = messages.value[0]["seq"] if messages.value else None
+    older = archive.load_messages(
+        session_id.value,
+        limit=OLDER_MESSAGES_PAGE,
+        before_seq=before_seq,
+        load_results=False
+    )
+    messages.value = [*older, *messages.value]
+    has_older_messages.value = bool(older) and archive.has_older_messages(
+        session_id.value, older[0]["seq"]
+    )
+    trim_results()
+
+
+def load_archived_result(seq, result_id):
+    """
+    Read the result of an archived message and chart it with the
+    `render_figures` task.
+
+    Parameters
+    ----------
+    seq : int
+        The archive sequence number of the message.
+    result_id : str
+        The id of the archived result.
+    """
+    dataframe = archive.load_result(result_id)
+    if dataframe is None:
+        replace_message(seq, result_id=None)
+        return
+    replace_message(seq, dataframe=dataframe, figure=None, figure_checked=False)
+    trim_results(keep_seq=seq)
+    render_figures()
+
+
+def load_or_create_figure(dataframe, sql, result_id):
+    """
+    Read the stored figure of an archived result, or create the figure and
+    store it next to the result. Blocks, so async tasks run it in a worker
+    thread.
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        The query result.
+    sql : str or None
+        The SQL query that produced the result.
+    result_id : str or None
+        The id of the archived result, None if it is not archived.
+
+    Returns
+    -------
+    go.Figure or None
+        The figure, or None if the result is not charted.
+    """
+    if result_id is not None:
+        figure = archive.load_figure(result_id)
+        if figure is not None:
+            return figure
+
+    figure = create_figure(dataframe, sql=sql)
+    if figure is not None and result_id is not None:
+        try:
+            archive.save_figure(result_id, figure)
+        except OSError as exc:
+            print(f"Failed to archive figure: {exc!r}")
+    return figure
+
+
+@solara.lab.task
+async def render_figures():
+    """
+    Create the charts of all assistant messages with a result but no chart yet.
+
+    Runs as its own task, so charts are created after the table is shown
+    without keeping `prompt_vanna` pending. Figures stored in the archive are
+    reused. Restarting the task, which
+    cancels a running one, picks up the messages the previous run did not
+    get to.
+
+    Returns
+    -------
+    None
+    """
+    pending = [
+        item for item in messages.value
+        if item["role"] == "assistant"
+        and item.get("dataframe", None) is not None
+        and not item.get("figure_checked", False)
+    ]
+
+    for item in pending:
+        figure = await asyncio.to_thread(
+            load_or_create_figure,
+            item["dataframe"],
+            item.get("sql", None),
+            item.get("result_id", None)
+        )
+        # The result may have been dropped from memory in the meantime
+        if any(
+            current.get("seq") == item["seq"] and current.get("dataframe", None) is not None
+            for current in messages.value
+        ):
+            replace_message(item["seq"], figure=figure, figure_checked=True)
+
+
+def create_assistant_message(content="", dataframe=None, sql=None):
     """
     Create a message dictionary representing the assistant's message.
 
@@ -44,6 +307,8 @@ def create_assistant_message(content="", dataframe=None):
         The content of the assistant's message (default is "").
     dataframe : pd.DataFrame or None, optional
         An optional DataFrame included with the message (default is None).
+    sql : str or None, optional
+        The SQL query that produced the DataFrame (default is None).
     
     Returns
     -------
@@ -52,6 +317,9 @@ def create_assistant_message(content="", dataframe=None):
         - "role": str, fixed as "assistant"
         - "content": str, the message content
         - "dataframe": pd.DataFrame or None, associated data
+        - "figure": go.Figure or None, chart of the data, added later
+        - "figure_checked": bool, False until the chart has been created
+        - "sql": str or None, the SQL query that produced the data
         - "is_end_of_stream": bool, False by default
         - "is_sql_statement": bool, False by default
     """
@@ -59,6 +327,9 @@ def create_assistant_message(content="", dataframe=None):
         "role": "assistant",
         "content": content,
         "dataframe": dataframe,
+        "figure": None,
+        "figure_checked": False,
+        "sql": sql,
         "is_end_of_stream": False, 
         "is_sql_statement": False
     }
@@ -69,6 +340,14 @@ async def prompt_vanna(message: str):
     """
     Process user message, generate SQL query and response, update message history.
 
+    The chart of the query result is created by the `render_figures` task
+    after the table has been shown. Both messages are appended to the
+    conversation archive.
+
+    The LLM calls, which may wait for the rate limits of `llm_scheduler`, and
+    the archive writes run in worker threads, so they do not block the event
+    loop shared by all sessions.
+
     Parameters
     ----------
     message : str
@@ -78,12 +357,14 @@ async def prompt_vanna(message: str):
     -------
     None
     """
-    messages.value = [
-        *messages.value,
-        {"role": "user", "content": message},
-    ]
+    session = session_id.value
+    user_message = await asyncio.to_thread(
+        archive_message, session, {"role": "user", "content": message}
+    )
+    messages.value = [*messages.value, user_message]
 
-    sql_query, sql_query_result, sql_query_plot = vn.ask(
+    sql_query, sql_query_result, sql_query_plot = await asyncio.to_thread(
+        vn.ask,
         question=message,
         visualize=False,
         print_results=False
@@ -92,6 +373,7 @@ async def prompt_vanna(message: str):
     if sql_query_result is None:
         result_message = sql_query
         dataframe = None
+        sql = None
     else:
         result_message = (
             "```sql \n"
@@ -100,17 +382,27 @@ async def prompt_vanna(message: str):
             "```"
         )
         dataframe = sql_query_result
+        sql = sql_query
 
     messages.value = [
         *messages.value, 
-        create_assistant_message(result_message, dataframe)
+        create_assistant_message(result_message, dataframe, sql)
     ]
 
     messages.value[-1]['is_end_of_stream'] = True
 
-    if find_sql(result_message) == True:
+    if await asyncio.to_thread(find_sql, result_message) == True:
         messages.value[-1]['is_sql_statement'] = True
 
+    assistant_message = await asyncio.to_thread(archive_message, session, messages.value[-1])
+    messages.value = [*messages.value[:-1], assistant_message]
+    trim_messages()
+    trim_results()
+    refresh_sessions()
+
+    if dataframe is not None:
+        render_figures()
+
     return
 
 
@@ -172,14 +464,14 @@ def render_buttons_row(item, user_message):
 
 def render_chat_message(idx, item):
     """
-    Render a chat message with optional embedded DataFrame and feedback buttons.
+    Render a chat message with optional embedded DataFrame, chart and feedback buttons.
 
     Parameters
     ----------
     idx : int
         The index of the message in the messages list.
     item : dict
-        The message dictionary containing role, content, dataframe, etc.
+        The message dictionary containing role, content, dataframe, figure, etc.
 
     Returns
     -------
@@ -198,6 +490,20 @@ def render_chat_message(idx, item):
         if (item["role"] == "assistant") and (item.get("dataframe", None) is not None):
             solara.DataFrame(item.get("dataframe"), items_per_page=5)
             solara.Markdown("")
+
+        if (item["role"] == "assistant") and (item.get("figure", None) is not None):
+            solara.FigurePlotly(item.get("figure"))
+
+        # Results of older archived messages are only read on request
+        if (item["role"] == "assistant") and (item.get("dataframe", None) is None) \
+                and (item.get("result_id", None) is not None):
+            solara.Button(
+                label="load result",
+                outlined=True,
+                color="primary",
+                icon_name="mdi-table",
+                on_click=partial(load_archived_result, item["seq"], item["result_id"]),
+            )
     
         if (item["role"] == "assistant"):
             # Get the previous (user) message index for using it in feedback
@@ -213,6 +519,7 @@ def render_chatbox():
 
     Uses:
     - solara.lab.ChatBox() context to encapsulate chat messages.
+    - Shows a button to load older messages from the archive, if there are any.
     - Skips messages with the role 'system'.
     - Delegates rendering each message to `render_chat_message`.
 
@@ -220,6 +527,15 @@ def render_chatbox():
     None
     """
     with solara.lab.ChatBox():
+        if has_older_messages.value:
+            solara.Button(
+                label="load older messages",
+                text=True,
+                color="primary",
+                icon_name="mdi-history",
+                on_click=load_older_messages,
+            )
+
         for i, item in enumerate(messages.value):
             if (item["role"] == "system"):
                 continue
@@ -227,6 +543,60 @@ def render_chatbox():
             render_chat_message(idx=i, item=item)
 
 
+def render_session_controls(router):
+    """
+    Render the conversation selector with buttons to start a new
+    conversation and to delete the open one.
+
+    Parameters
+    ----------
+    router : solara.Router
+        The router used to switch conversations through the URL.
+
+    Returns
+    -------
+    None
+    """
+    labels = {
+        f"{datetime.datetime.fromtimestamp(last_ts):%Y-%m-%d %H:%M} "
+        f"({count} messages, {archived_session_id[:8]})": archived_session_id
+        for archived_session_id, last_ts, count in sessions.value
+    }
+    current = next(
+        (label for label, archived_session_id in labels.items() if archived_session_id == session_id.value),
+        None
+    )
+
+    def open_conversation(label):
+        if label in labels:
+            router.push(f"{router.path}?session={labels[label]}")
+
+    with solara.Row(style={"alignItems": "center"}):
+        solara.Select(
+            label="Conversation",
+            values=list(labels),
+            value=current,
+            on_value=open_conversation,
+            disabled=prompt_vanna.pending,
+        )
+        solara.Button(
+            label="new conversation",
+            text=True,
+            color="primary",
+            icon_name="mdi-plus",
+            disabled=prompt_vanna.pending,
+            on_click=lambda: router.push(f"{router.path}?session={uuid.uuid4().hex}"),
+        )
+        solara.Button(
+            label="delete conversation",
+            text=True,
+            color="error",
+            icon_name="mdi-delete",
+            disabled=prompt_vanna.pending or current is None,
+            on_click=partial(delete_conversation, router),
+        )
+
+
 def render_progress_bar():
     """
     Render a simple progress indicator as a linear progress bar with placeholder text.
@@ -246,7 +616,8 @@ def render_chat_input():
     Uses:
     - solara.lab.ChatInput() component for user message input.
     - Sets callback `prompt_vanna` to process submitted messages.
-    - Controls input and send button disable states based on `prompt_vanna.pending`.
+    - Controls input and send button disable states based on `prompt_vanna.pending`
+      and whether the session has been opened.
     - Enables autofocus on the input field.
     - Assigns a unique key to the component for React-style reactivity.
 
@@ -254,17 +625,32 @@ def render_chat_input():
     -------
     None
     """
+    # Messages can only be archived once the session has been opened
+    disabled = prompt_vanna.pending or session_id.value is None
+
     solara.lab.ChatInput(
         send_callback=prompt_vanna, 
-        disabled=prompt_vanna.pending, 
-        disabled_input=prompt_vanna.pending, 
-        disabled_send=prompt_vanna.pending, 
+        disabled=disabled, 
+        disabled_input=disabled, 
+        disabled_send=disabled, 
         autofocus=True
     ).key("input")
 
 
 @solara.component
 def Page():
+    # The session id is kept in the URL, so a page refresh reopens the conversation
+    router = solara.use_router()
+    requested_session_id = parse_qs(router.search or "").get("session", [None])[0]
+
+    def open_session():
+        if requested_session_id is None:
+            router.push(f"{router.path}?session={uuid.uuid4().hex}")
+        elif requested_session_id != session_id.value:
+            load_session(requested_session_id)
+
+    solara.use_effect(open_session, [requested_session_id])
+
     with solara.Column(
         style={
             "width": "100%",
@@ -277,7 +663,9 @@ def Page():
         }
     ):
         solara.Title("Solara SQL Chatbot")
-        
+
+        render_session_controls(router)
+
         # Show Chatbox
         render_chatbox()
         
@@ -0,0 +1,150 @@
+import os
+
+import pandas as pd
+import pytest
+
+from utils.archive import ConversationArchive
+
+pytest.importorskip("pyarrow")
+
+
+def message(content, dataframe=None):
+    return {"role": "user", "content": content, "dataframe": dataframe}
+
+
+def contents(messages):
+    return [item["content"] for item in messages]
+
+
+def segment_files(archive, suffix=".jsonl"):
+    return sorted(name for name in os.listdir(archive.segments_path) if name.endswith(suffix))
+
+
+def test_messages_and_results_survive_a_restart(tmp_path):
+    archive = ConversationArchive(str(tmp_path))
+    archive.append_message("a", message("question"))
+    _, result_id = archive.append_message("a", message("answer", pd.DataFrame({"x": [1, 2]})))
+
+    reopened = ConversationArchive(str(tmp_path))
+    loaded = reopened.load_messages("a", limit=10)
+
+    assert contents(loaded) == ["question", "answer"]
+    assert loaded[1]["result_id"] == result_id
+    assert loaded[1]["dataframe"]["x"].tolist() == [1, 2]
+
+
+def test_reopen_after_a_crash_mid_write(tmp_path):
+    archive = ConversationArchive(str(tmp_path))
+    archive.append_message("a", message("first"))
+
+    # A crash while appending leaves an incomplete last line
+    active = os.path.join(archive.segments_path, segment_files(archive)[-1])
+    with open(active, "ab") as file:
+        file.write(b'{"role":"user","content":"torn')
+
+    reopened = ConversationArchive(str(tmp_path))
+    reopened.append_message("a", message("second"))
+
+    assert contents(ConversationArchive(str(tmp_path)).load_messages("a", limit=10)) == ["first", "second"]
+
+
+def test_corrupt_lines_are_skipped(tmp_path):
+    archive = ConversationArchive(str(tmp_path))
+    archive.append_message("a", message("first"))
+    active = os.path.join(archive.segments_path, segment_files(archive)[-1])
+    with open(active, "ab") as file:
+        file.write(b"not json\n")
+    archive = ConversationArchive(str(tmp_path))
+    archive.append_message("a", message("second"))
+
+    assert contents(ConversationArchive(str(tmp_path)).load_messages("a", limit=10)) == ["first", "second"]
+
+
+def test_paging_across_sealed_segments(tmp_path):
+    archive = ConversationArchive(str(tmp_path), segment_max_bytes=400)
+    for i in range(30):
+        archive.append_message("a" if i % 2 else "b", message(f"m{i}"))
+    assert len(segment_files(archive)) > 3
+
+    reopened = ConversationArchive(str(tmp_path), segment_max_bytes=400)
+    latest = reopened.load_messages("a", limit=5)
+    older = reopened.load_messages("a", limit=5, before_seq=latest[0]["seq"])
+
+    assert contents(latest) == [f"m{i}" for i in range(21, 30, 2)]
+    assert contents(older) == [f"m{i}" for i in range(11, 20, 2)]
+    assert reopened.has_older_messages("a", older[0]["seq"])
+    assert not reopened.has_older_messages("a", 0)
+
+
+def test_sealed_segments_get_a_persisted_index(tmp_path):
+    archive = ConversationArchive(str(tmp_path), segment_max_bytes=400)
+    for i in range(20):
+        archive.append_message("a", message(f"m{i}"))
+
+    # Every sealed segment has an index, the active one is scanned on start-up
+    assert len(segment_files(archive, ".idx")) == len(segment_files(archive)) - 1
+
+    reopened = ConversationArchive(str(tmp_path), segment_max_bytes=400)
+    sealed = [number for number in reopened._segments if number != reopened._active]
+    assert all(reopened._segments[number].entries is None for number in sealed)
+    assert [(session[0], session[2]) for session in reopened.list_sessions()] == [("a", 20)]
+
+
+def test_stale_index_is_rebuilt(tmp_path):
+    archive = ConversationArchive(str(tmp_path), segment_max_bytes=400)
+    for i in range(20):
+        archive.append_message("a", message(f"m{i}"))
+
+    index_file = os.path.join(archive.segments_path, segment_files(archive, ".idx")[0])
+    with open(index_file, "wb") as file:
+        file.write(b"{")
+
+    reopened = ConversationArchive(str(tmp_path), segment_max_bytes=400)
+    assert contents(reopened.load_messages("a", limit=20)) == [f"m{i}" for i in range(20)]
+
+
+def test_sessions_are_listed_by_last_activity(tmp_path):
+    archive = ConversationArchive(str(tmp_path))
+    archive.append_message("a", message("1"))
+    archive.append_message("b", message("2"))
+    archive.append_message("a", message("3"))
+
+    assert [session[0] for session in archive.list_sessions()] == ["a", "b"]
+    assert archive.list_sessions(limit=1)[0][2] == 2
+
+
+def test_deleted_sessions_are_compacted(tmp_path):
+    archive = ConversationArchive(str(tmp_path), segment_max_bytes=400)
+    _, result_id = archive.append_message("a", message("gone", pd.DataFrame({"x": [1]})))
+    for i in range(10):
+        archive.append_message("b", message(f"kept{i}"))
+    archive.delete_session("a")
+    assert archive.load_messages("a", limit=10) == []
+
+    # Sealing the segment with the tombstone compacts the archive
+    for i in range(10):
+        archive.append_message("b", message(f"later{i}"))
+
+    assert archive.load_result(result_id) is None
+    assert not any(index.deleted for index in archive._segments.values())
+
+    reopened = ConversationArchive(str(tmp_path), segment_max_bytes=400)
+    assert [session[0] for session in reopened.list_sessions()] == ["b"]
+    assert len(reopened.load_messages("b", limit=100)) == 20
+
+
+def test_retention_removes_the_oldest_segments(tmp_path):
+    archive = ConversationArchive(str(tmp_path), segment_max_bytes=400, max_bytes=3000)
+    result_ids = []
+    for i in range(40):
+        _, result_id = archive.append_message("a", message(f"m{i}", pd.DataFrame({"x": [i]})))
+        result_ids.append(result_id)
+
+    assert archive._size <= 3000
+    assert archive.load_result(result_ids[0]) is None
+    assert archive.load_messages("a", limit=1)[0]["content"] == "m39"
+
+    reopened = ConversationArchive(str(tmp_path), segment_max_bytes=400, max_bytes=3000)
+    loaded = reopened.load_messages("a", limit=100)
+    assert contents(loaded)[-1] == "m39"
+    assert "m0" not in contents(loaded)
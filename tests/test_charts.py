@@ -0,0 +1,166 @@
+import datetime
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import charts
+from utils.charts import (
+    MAX_POINTS,
+    MAX_SERIES,
+    FigureCache,
+    coerce_columns,
+    create_figure,
+    grid_bin_indices,
+    infer_chart,
+    lttb_indices,
+)
+
+
+def test_lttb_keeps_endpoints_and_threshold():
+    x = np.arange(10000, dtype=float)
+    y = np.sin(x / 100)
+
+    keep = lttb_indices(x, y, 500)
+
+    assert len(keep) == 500
+    assert keep[0] == 0 and keep[-1] == len(x) - 1
+    assert np.all(np.diff(keep) > 0)
+
+
+def test_lttb_keeps_spikes():
+    x = np.arange(10000, dtype=float)
+    y = np.zeros(10000)
+    y[4321] = 100.0
+
+    assert 4321 in lttb_indices(x, y, 100)
+
+
+def test_lttb_returns_all_points_below_threshold():
+    x = np.arange(10, dtype=float)
+    assert list(lttb_indices(x, x, 100)) == list(range(10))
+
+
+def test_grid_binning_bounds_points():
+    rng = np.random.default_rng(0)
+    x, y = rng.random(50000), rng.random(50000)
+
+    keep = grid_bin_indices(x, y, 1000)
+
+    assert 0 < len(keep) <= 1000
+    assert np.all(np.diff(keep) > 0)
+
+
+def test_coerce_columns_converts_decimals_and_dates_only():
+    df = pd.DataFrame({
+        "price": [Decimal("1.50"), Decimal("2.25")],
+        "zip_code": ["00123", "45678"],
+        "day": [datetime.date(2024, 1, 1), datetime.date(2024, 1, 2)],
+    })
+
+    coerced = coerce_columns(df)
+
+    assert pd.api.types.is_float_dtype(coerced["price"])
+    assert coerced["zip_code"].tolist() == ["00123", "45678"]
+    assert pd.api.types.is_datetime64_any_dtype(coerced["day"])
+
+
+def test_infer_chart_skips_identifier_columns():
+    df = pd.DataFrame({
+        "customer_id": [1, 2, 3],
+        "name": ["a", "b", "c"],
+        "revenue": [Decimal("10.5"), Decimal("3"), Decimal("7.25")],
+    })
+
+    assert infer_chart(coerce_columns(df)) == {"kind": "bar", "x": "name", "y": ["revenue"]}
+
+
+def test_infer_chart_without_measures():
+    df = pd.DataFrame({"id": [1, 2, 3], "name": ["a", "b", "c"]})
+    assert infer_chart(coerce_columns(df)) is None
+
+
+def test_infer_chart_splits_long_format_by_category():
+    df = pd.DataFrame({
+        "day": pd.date_range("2024-01-01", periods=4).repeat(2),
+        "region": ["north", "south"] * 4,
+        "sales": np.arange(8, dtype=float),
+    })
+
+    spec = infer_chart(df)
+    assert spec == {"kind": "line", "x": "day", "y": ["sales"], "group": "region"}
+
+    figure = create_figure(df)
+    assert sorted(trace.name for trace in figure.data) == ["north", "south"]
+    assert all(len(trace.x) == 4 for trace in figure.data)
+
+
+def test_long_format_keeps_largest_categories():
+    df = pd.DataFrame({
+        "day": pd.date_range("2024-01-01", periods=3).repeat(8),
+        "region": [f"r{i}" for i in range(8)] * 3,
+        "sales": np.tile(np.arange(8, dtype=float), 3),
+    })
+
+    names = [trace.name for trace in create_figure(df).data]
+
+    assert len(names) == MAX_SERIES + 1
+    assert names[-1] == "Other"
+    assert "r7" in names and "r0" not in names
+
+
+def test_large_series_are_downsampled():
+    n = 100000
+    df = pd.DataFrame({
+        "ts": pd.date_range("2020-01-01", periods=n, freq="min"),
+        "value": np.random.default_rng(0).standard_normal(n).cumsum(),
+    })
+
+    figure = create_figure(df)
+
+    assert figure.data[0].type == "scattergl"
+    assert len(figure.data[0].x) == MAX_POINTS
+
+
+def test_histogram_ignores_infinite_values():
+    df = pd.DataFrame({"value": [1.0, np.inf, 2.0, -np.inf, 3.0]})
+
+    figure = create_figure(df)
+
+    assert figure.data[0].type == "bar"
+    assert figure.data[0].y.sum() == 3
+
+
+def test_json_columns_do_not_fail():
+    df = pd.DataFrame({"payload": [{"a": 1}, {"b": 2}], "amount": [1.0, 2.0]})
+
+    figure = create_figure(df, sql="SELECT payload, amount FROM t")
+
+    assert figure.data[0].type == "bar"
+
+
+def test_chart_failures_return_no_figure(monkeypatch):
+    def failing_build(df, spec):
+        raise ValueError("broken chart")
+
+    monkeypatch.setattr(charts, "build_figure", failing_build)
+    df = pd.DataFrame({"category": ["a", "b"], "amount": [1.0, 2.0]})
+
+    assert create_figure(df) is None
+
+
+def test_figures_are_cached_by_sql_and_shape():
+    df = pd.DataFrame({"name": ["a", "b"], "amount": [1.0, 2.0]})
+    sql = "SELECT name, amount FROM cached"
+
+    first = create_figure(df, sql=sql)
+
+    assert create_figure(df.copy(), sql=sql) is first
+    assert create_figure(df) is not first
+    assert FigureCache.key(sql, df) != FigureCache.key(sql, df.iloc[:1])
+
+
+@pytest.mark.parametrize("df", [None, pd.DataFrame(), pd.DataFrame({"amount": [1.0]})])
+def test_nothing_to_chart(df):
+    assert create_figure(df) is None
@@ -0,0 +1,290 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from utils import llm_scheduler as scheduler_module
+from utils.llm_scheduler import (
+    AdaptiveConcurrencyLimit,
+    LLMScheduler,
+    Priority,
+    TokenBucket,
+    current_priority,
+    estimate_tokens,
+    priority_lane,
+    retry_after,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+def make_scheduler(**kwargs):
+    options = dict(
+        requests_per_minute=60000,
+        tokens_per_minute=10000000,
+        max_concurrency=4,
+        base_delay=0.001,
+        max_delay=0.01,
+    )
+    options.update(kwargs)
+    return LLMScheduler(**options)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def test_token_bucket_refills_per_minute(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler_module.time, "monotonic", clock)
+    bucket = TokenBucket(60)
+
+    bucket.consume(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+
+    clock.now += 30
+    assert bucket.wait_time(30) == 0.0
+    assert bucket.wait_time(31) == pytest.approx(1.0)
+
+    # Larger requests than the capacity wait for a full bucket
+    assert bucket.wait_time(1000) == pytest.approx(30.0)
+
+
+def test_token_bucket_refund_is_capped(monkeypatch):
+    monkeypatch.setattr(scheduler_module.time, "monotonic", FakeClock())
+    bucket = TokenBucket(100)
+
+    bucket.consume(40)
+    bucket.refund(1000)
+    assert bucket.tokens == 100
+
+
+def test_adaptive_concurrency_limit_is_aimd():
+    limit = AdaptiveConcurrencyLimit(initial=4, minimum=1, maximum=8)
+
+    # About one slot is added per window of `limit` successes
+    for _ in range(5):
+        limit.on_success()
+    assert limit.value == 5
+
+    limit.on_throttle()
+    assert limit.value == 2
+
+    for _ in range(10):
+        limit.on_throttle()
+    assert limit.value == 1
+
+    for _ in range(1000):
+        limit.on_success()
+    assert limit.value == 8
+
+
+def test_retry_after_prefers_milliseconds():
+    assert retry_after(StatusError(429, {"retry-after-ms": "250", "retry-after": "1"})) == 0.25
+    assert retry_after(StatusError(429, {"retry-after": "2"})) == 2.0
+    assert retry_after(StatusError(429)) is None
+
+
+def test_estimate_tokens_includes_completion_budget():
+    messages = [{"role": "user", "content": "x" * 40}]
+    assert estimate_tokens(messages, max_tokens=100) == 10 + 4 + 100
+
+
+def test_interactive_calls_are_served_before_batch_calls():
+    scheduler = make_scheduler(max_concurrency=1)
+    release = threading.Event()
+    order = []
+
+    blocker = threading.Thread(target=scheduler.call, args=(release.wait,))
+    blocker.start()
+    wait_until(lambda: scheduler.metrics()["in_flight"] == 1)
+
+    threads = []
+    for name, priority in (("batch", Priority.BATCH), ("interactive", Priority.INTERACTIVE)):
+        thread = threading.Thread(
+            target=scheduler.call,
+            args=(lambda name=name: order.append(name),),
+            kwargs={"priority": priority},
+        )
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda count=len(threads): scheduler.metrics()["queued"] == count)
+
+    release.set()
+    for thread in [blocker, *threads]:
+        thread.join()
+
+    assert order == ["interactive", "batch"]
+
+
+def test_rate_limited_calls_are_retried_and_shrink_the_limit():
+    scheduler = make_scheduler(max_concurrency=8)
+    attempts = []
+
+    def throttled_twice():
+        attempts.append(1)
+        if len(attempts) <= 2:
+            raise StatusError(429, {"retry-after-ms": "1"})
+        return "ok"
+
+    assert scheduler.call(throttled_twice) == "ok"
+    assert len(attempts) == 3
+    # Halved from 4 to 2 and 1, then one success adds 1 / 1
+    assert scheduler.concurrency.value == 2
+
+    metrics = scheduler.metrics()
+    assert metrics["queue_wait_seconds"]["count"] == 1
+    assert metrics["in_flight"] == 0
+
+
+def test_server_errors_do_not_change_the_limit():
+    scheduler = make_scheduler(max_concurrency=8, max_retries=2)
+    limit = scheduler.concurrency.limit
+
+    def failing():
+        raise StatusError(500)
+
+    with pytest.raises(StatusError):
+        scheduler.call(failing)
+
+    assert scheduler.concurrency.limit == limit
+    assert scheduler.metrics()["queue_wait_seconds"]["count"] == 1
+
+
+def test_non_retryable_errors_are_raised_immediately():
+    scheduler = make_scheduler()
+    attempts = []
+
+    def bad_request():
+        attempts.append(1)
+        raise StatusError(400)
+
+    with pytest.raises(StatusError):
+        scheduler.call(bad_request)
+    assert len(attempts) == 1
+
+
+def test_reported_usage_settles_the_token_bucket():
+    scheduler = make_scheduler(tokens_per_minute=1000)
+
+    scheduler.call(lambda: SimpleNamespace(usage=SimpleNamespace(total_tokens=900)), tokens=100)
+    assert scheduler.token_bucket.tokens == pytest.approx(100, abs=1)
+
+    scheduler.call(lambda: SimpleNamespace(usage=SimpleNamespace(total_tokens=10)), tokens=50)
+    assert scheduler.token_bucket.tokens == pytest.approx(90, abs=1)
+
+
+def test_priority_lane_sets_the_current_priority():
+    assert current_priority.get() == Priority.INTERACTIVE
+    with priority_lane(Priority.BATCH):
+        assert current_priority.get() == Priority.BATCH
+    assert current_priority.get() == Priority.INTERACTIVE
+
+
+class FakeAzureOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Minimal Azure OpenAI chat completions endpoint answering two out of
+    three requests with HTTP 429 and `Retry-After`.
+    """
+    lock = threading.Lock()
+    requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        with self.lock:
+            FakeAzureOpenAIHandler.requests += 1
+            throttle = FakeAzureOpenAIHandler.requests % 3 != 0
+
+        if throttle:
+            body = {"error": {"code": "429", "message": "Rate limit is exceeded."}}
+            self._send(429, body, {"Retry-After": "1", "retry-after-ms": "50"})
+            return
+
+        self._send(200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "fake",
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "true"},
+            }],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+        })
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fake_endpoint():
+    FakeAzureOpenAIHandler.requests = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAzureOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_scheduler_against_fake_endpoint_returning_429(fake_endpoint):
+    openai = pytest.importorskip("openai")
+    client = openai.AzureOpenAI(
+        api_version="2024-10-21",
+        azure_endpoint=fake_endpoint,
+        api_key="fake",
+        max_retries=0
+    )
+    scheduler = make_scheduler(max_concurrency=8, max_retries=10, base_delay=0.01, max_delay=1.0)
+    messages = [{"role": "user", "content": "SELECT 1"}]
+    num_calls = 12
+
+    def complete(i):
+        response = scheduler.call(
+            lambda: client.chat.completions.create(model="fake", messages=messages, max_tokens=2),
+            priority=Priority.BATCH if i % 2 else Priority.INTERACTIVE,
+            tokens=estimate_tokens(messages, max_tokens=2),
+        )
+        return response.choices[0].message.content
+
+    with ThreadPoolExecutor(max_workers=num_calls) as executor:
+        results = list(executor.map(complete, range(num_calls)))
+
+    assert results == ["true"] * num_calls
+    assert FakeAzureOpenAIHandler.requests == 3 * num_calls
+
+    metrics = scheduler.metrics()
+    assert metrics["queue_wait_seconds"]["count"] == num_calls
+    assert metrics["in_flight"] == 0
+    assert metrics["concurrency_limit"] < 4
@@ -0,0 +1,713 @@
+import os
+import json
+import time
+import uuid
+import threading
+import pandas as pd
+import plotly.io as pio
+from dotenv import load_dotenv
+
+load_dotenv('.env', override=True)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", ".archive")
+
+# A segment is sealed and a new one started once it grows beyond this size
+SEGMENT_MAX_BYTES = int(os.getenv("ARCHIVE_SEGMENT_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# Oldest segments and their results are dropped once the archive grows beyond this size
+ARCHIVE_MAX_BYTES = int(os.getenv("ARCHIVE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".jsonl"
+INDEX_SUFFIX = ".idx"
+
+# Message fields stored in the segment records, everything else is left out
+MESSAGE_FIELDS = ("role", "content", "sql", "is_sql_statement", "is_end_of_stream")
+
+# Sealed segments smaller than this share of the segment size are merged by `compact`
+COMPACT_MIN_FILL = 0.5
+
+
+class SegmentIndex:
+    """
+    Index of the records of one segment.
+
+    The index of a sealed segment is persisted next to it as a JSON lines
+    file. The first line is a summary with the segment size, the highest
+    sequence number, the tombstones, the result ids and, per session, the
+    first and last sequence numbers, the first and last timestamps, the
+    message count and where the session's entries are stored. Every further
+    line holds the `[seq, ts, offset]` entries of one session, so that only
+    the summary is read on start-up and the entries of a session are read
+    when it is opened.
+
+    Records of a session older than a tombstone in the same segment are not
+    indexed.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.max_seq = -1
+        self.deleted = {}
+        self.results = []
+        self.sessions = {}
+        self.entries = {}
+        self.path = None
+        self.header_size = 0
+
+    def add(self, record, offset):
+        """
+        Index a record written at `offset`. The caller keeps `bytes` up to date.
+        """
+        session_id, seq, ts = record["session_id"], record["seq"], record["ts"]
+        self.max_seq = seq
+        if record.get("deleted", False):
+            self.deleted[session_id] = seq
+            self.sessions.pop(session_id, None)
+            self.entries.pop(session_id, None)
+            return
+
+        if record.get("result_id"):
+            self.results.append(record["result_id"])
+        self.entries.setdefault(session_id, []).append([seq, ts, offset])
+        summary = self.sessions.setdefault(
+            session_id, {"first_seq": seq, "min_ts": ts, "count": 0}
+        )
+        summary.update(last_seq=seq, max_ts=ts, count=summary["count"] + 1)
+
+    def write(self, path):
+        """
+        Persist the index atomically and drop the entries from memory.
+        """
+        lines, position = [], 0
+        for session_id, entries in self.entries.items():
+            line = (json.dumps(entries, separators=(",", ":")) + "\n").encode("utf-8")
+            self.sessions[session_id]["at"] = position
+            lines.append(line)
+            position += len(line)
+
+        header = {
+            "bytes": self.bytes,
+            "max_seq": self.max_seq,
+            "deleted": self.deleted,
+            "results": self.results,
+            "sessions": self.sessions,
+        }
+        header_line = (json.dumps(header, separators=(",", ":")) + "\n").encode("utf-8")
+        with open(path + ".tmp", "wb") as file:
+            file.write(header_line)
+            file.writelines(lines)
+        os.replace(path + ".tmp", path)
+
+        self.entries = None
+        self.path = path
+        self.header_size = len(header_line)
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read the summary of a persisted index, or return None if it is
+        missing or unreadable.
+        """
+        try:
+            with open(path, "rb") as file:
+                header_line = file.readline()
+            header = json.loads(header_line)
+        except (OSError, ValueError):
+            return None
+
+        index = cls()
+        index.bytes = header["bytes"]
+        index.max_seq = header["max_seq"]
+        index.deleted = header["deleted"]
+        index.results = header["results"]
+        index.sessions = header["sessions"]
+        index.entries = None
+        index.path = path
+        index.header_size = len(header_line)
+        return index
+
+    def session_entries(self, session_id):
+        """
+        Return the `[seq, ts, offset]` entries of a session in this segment,
+        reading them from disk if the index is persisted.
+        """
+        if self.entries is not None:
+            return self.entries.get(session_id, [])
+        summary = self.sessions.get(session_id)
+        if summary is None:
+            return []
+        with open(self.path, "rb") as file:
+            file.seek(self.header_size + summary["at"])
+            return json.loads(file.readline())
+
+
+class ConversationArchive:
+    """
+    Append-only, segment-based on-disk archive of chat messages and results.
+
+    Messages are appended as compact JSON lines to numbered segment files,
+    and query results are stored as one Parquet file each, next to the JSON
+    of their downsampled figure. Each sealed segment has a persisted
+    `SegmentIndex`; only their summaries, one per session and segment, are
+    kept in memory, and the entries of a session are read when it is loaded.
+    The active segment is scanned on start-up, and a last line left
+    incomplete by a crash is cut off.
+
+    Deleting a session appends a tombstone record; `compact` rewrites the
+    sealed segments holding deleted records and merges small segments.
+    When the archive exceeds `max_bytes`, the oldest segments and their
+    results are removed, then the oldest results of the active segment.
+
+    The archive is safe to use from several threads of a single process.
+
+    Parameters
+    ----------
+    path : str
+        Directory holding the archive.
+    segment_max_bytes : int, optional
+        Size at which the active segment is sealed (default is SEGMENT_MAX_BYTES).
+    max_bytes : int, optional
+        Size-based retention limit (default is ARCHIVE_MAX_BYTES).
+    """
+
+    def __init__(self, path, segment_max_bytes=SEGMENT_MAX_BYTES, max_bytes=ARCHIVE_MAX_BYTES):
+        self.path = path
+        self.segments_path = os.path.join(path, "segments")
+        self.results_path = os.path.join(path, "results")
+        self.segment_max_bytes = segment_max_bytes
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+
+        os.makedirs(self.segments_path, exist_ok=True)
+        os.makedirs(self.results_path, exist_ok=True)
+        self._load_index()
+
+    def _segment_file(self, number):
+        return os.path.join(self.segments_path, f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}")
+
+    def _index_file(self, number):
+        return os.path.join(self.segments_path, f"{SEGMENT_PREFIX}{number:06d}{INDEX_SUFFIX}")
+
+    def _result_file(self, result_id):
+        return os.path.join(self.results_path, f"{result_id}.parquet")
+
+    def _figure_file(self, result_id):
+        return os.path.join(self.results_path, f"{result_id}.figure.json")
+
+    def _segment_numbers(self):
+        numbers = []
+        for name in os.listdir(self.segments_path):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                numbers.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(numbers)
+
+    def _read_segment(self, number):
+        """
+        Yield `(offset, record)` pairs of a segment. A truncated last line,
+        left by an interrupted write, and lines that cannot be decoded are
+        skipped.
+        """
+        with open(self._segment_file(number), "rb") as file:
+            offset = 0
+            for line in file:
+                if line.endswith(b"\n"):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        print(f"Skipping corrupt archive record in segment {number} at {offset}")
+                    else:
+                        yield offset, record
+                offset += len(line)
+
+    def _scan_segment(self, number):
+        index = SegmentIndex()
+        for offset, record in self._read_segment(number):
+            index.add(record, offset)
+        index.bytes = os.path.getsize(self._segment_file(number))
+        return index
+
+    def _truncate_partial_tail(self, number):
+        """
+        Cut a segment back to its last complete line, so that the next
+        record is not appended to a line left incomplete by a crash.
+        """
+        path = self._segment_file(number)
+        size = os.path.getsize(path)
+        with open(path, "rb+") as file:
+            end = size
+            while end > 0:
+                start = max(0, end - 65536)
+                file.seek(start)
+                newline = file.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                print(f"Truncating incomplete archive record in segment {number} at {end}")
+                file.truncate(end)
+
+    def _load_segment_index(self, number):
+        """
+        Read the persisted index of a sealed segment, rebuilding it when it
+        is missing or does not match the segment, e.g. after a crash.
+        """
+        index = SegmentIndex.read(self._index_file(number))
+        if index is None or index.bytes != os.path.getsize(self._segment_file(number)):
+            index = self._scan_segment(number)
+            index.write(self._index_file(number))
+        return index
+
+    def _load_index(self):
+        """
+        Load the summaries of the sealed segments and scan the active one.
+        """
+        self._segments = {}
+        self._next_seq = 0
+
+        numbers = self._segment_numbers()
+        self._active = numbers[-1] if numbers else 1
+        for number in numbers[:-1]:
+            index = self._load_segment_index(number)
+            # Records are written in sequence order, so a segment without
+            # newer records is a leftover of an interrupted compaction
+            if index.max_seq < self._next_seq:
+                os.remove(self._segment_file(number))
+                os.remove(self._index_file(number))
+                continue
+            self._segments[number] = index
+            self._next_seq = index.max_seq + 1
+
+        active = SegmentIndex()
+        if numbers:
+            self._truncate_partial_tail(self._active)
+            active = self._scan_segment(self._active)
+            # An index of the active segment is outdated by the next append
+            if os.path.exists(self._index_file(self._active)):
+                os.remove(self._index_file(self._active))
+        self._segments[self._active] = active
+        self._next_seq = max(self._next_seq, active.max_seq + 1)
+        self._active_size = active.bytes
+
+        self._rebuild_sessions()
+        self._size = sum(
+            entry.stat().st_size
+            for directory in (self.segments_path, self.results_path)
+            for entry in os.scandir(directory)
+        )
+
+    def _merge_session(self, session_id, number, summary):
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = {
+                "first_seq": summary["first_seq"], "count": 0, "segments": []
+            }
+        session["last_seq"] = summary["last_seq"]
+        session["last_ts"] = summary["max_ts"]
+        session["count"] += summary["count"]
+        if not session["segments"] or session["segments"][-1] != number:
+            session["segments"].append(number)
+
+    def _rebuild_sessions(self):
+        """
+        Combine the per-segment summaries into one summary per session.
+        """
+        self._sessions = {}
+        for number in sorted(self._segments):
+            index = self._segments[number]
+            for session_id in index.deleted:
+                self._sessions.pop(session_id, None)
+            for session_id, summary in index.sessions.items():
+                self._merge_session(session_id, number, summary)
+
+    @staticmethod
+    def _encode(record):
+        return (json.dumps(record, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+
+    def _seal_active(self):
+        index = self._segments[self._active]
+        index.write(self._index_file(self._active))
+        self._size += os.path.getsize(self._index_file(self._active))
+
+        self._active += 1
+        self._active_size = 0
+        self._segments[self._active] = SegmentIndex()
+
+    def _append_record(self, record):
+        line = self._encode(record)
+
+        sealed = self._active_size > 0 and self._active_size + len(line) > self.segment_max_bytes
+        if sealed:
+            self._seal_active()
+
+        offset = self._active_size
+        with open(self._segment_file(self._active), "ab") as file:
+            file.write(line)
+
+        self._active_size += len(line)
+        self._size += len(line)
+        self._segments[self._active].add(record, offset)
+        self._segments[self._active].bytes = self._active_size
+        if record.get("deleted", False):
+            self._sessions.pop(record["session_id"], None)
+        else:
+            summary = {"first_seq": record["seq"], "last_seq": record["seq"], "max_ts": record["ts"], "count": 1}
+            self._merge_session(record["session_id"], self._active, summary)
+
+        if sealed:
+            if any(index.deleted for index in self._segments.values()):
+                self.compact()
+            self.enforce_retention()
+
+    def _write_result(self, dataframe):
+        """
+        Write a DataFrame as Parquet, returning its result id, or None if it
+        cannot be stored.
+
+        Column names are made unique strings, as Parquet requires, e.g. for
+        `SELECT a.id, b.id`. Object columns that Arrow cannot convert, e.g.
+        json columns with varying keys, are stored as text.
+        """
+        dataframe = dataframe.copy(deep=False)
+        columns, seen = [], {}
+        for column in map(str, dataframe.columns):
+            count = seen.get(column, 0)
+            seen[column] = count + 1
+            columns.append(column if count == 0 else f"{column}_{count}")
+        dataframe.columns = columns
+
+        result_id = uuid.uuid4().hex
+        path = self._result_file(result_id)
+        try:
+            try:
+                dataframe.to_parquet(path, index=False)
+            except Exception:
+                for column in dataframe.columns[dataframe.dtypes == object]:
+                    dataframe[column] = dataframe[column].map(lambda value: None if value is None else str(value))
+                dataframe.to_parquet(path, index=False)
+        except Exception as exc:
+            print(f"Failed to archive result: {exc!r}")
+            if os.path.exists(path):
+                os.remove(path)
+            return None
+        return result_id
+
+    def append_message(self, session_id, message):
+        """
+        Append a message to the archive, storing its DataFrame as Parquet.
+        A DataFrame that cannot be stored is left out of the record.
+
+        Parameters
+        ----------
+        session_id : str
+            The conversation the message belongs to.
+        message : MessageDict
+            The message dictionary as used by the GUI.
+
+        Returns
+        -------
+        tuple
+            The sequence number of the stored record and the id of the stored
+            result, or None if the message has no DataFrame.
+        """
+        record = {field: message[field] for field in MESSAGE_FIELDS if field in message}
+
+        dataframe = message.get("dataframe", None)
+        if dataframe is not None:
+            result_id = self._write_result(dataframe)
+            if result_id is not None:
+                record["result_id"] = result_id
+
+        with self._lock:
+            if "result_id" in record:
+                self._size += os.path.getsize(self._result_file(record["result_id"]))
+            record.update(session_id=session_id, seq=self._next_seq, ts=time.time())
+            self._next_seq += 1
+            self._append_record(record)
+            if self._size > self.max_bytes:
+                self.enforce_retention()
+        return record["seq"], record.get("result_id", None)
+
+    def delete_session(self, session_id):
+        """
+        Delete a conversation. Its records are removed on the next compaction.
+
+        Parameters
+        ----------
+        session_id : str
+            The conversation to delete.
+        """
+        with self._lock:
+            if session_id not in self._sessions:
+                return
+            record = {"session_id": session_id, "seq": self._next_seq, "ts": time.time(), "deleted": True}
+            self._next_seq += 1
+            self._append_record(record)
+
+    def list_sessions(self, limit=None):
+        """
+        List archived conversations, most recently active first.
+
+        Parameters
+        ----------
+        limit : int, optional
+            Maximum number of conversations to list (default is None, all).
+
+        Returns
+        -------
+        list of tuple
+            `(session_id, last_activity_timestamp, message_count)` tuples.
+        """
+        with self._lock:
+            sessions = [
+                (session_id, session["last_ts"], session["count"])
+                for session_id, session in self._sessions.items()
+            ]
+        sessions.sort(key=lambda session: session[1], reverse=True)
+        return sessions[:limit]
+
+    def _session_entries(self, session_id, limit, before_seq):
+        """
+        Return the latest `[seq, ts, number, offset]` entries of a session,
+        reading the persisted indexes of its newest segments first.
+        """
+        session = self._sessions.get(session_id)
+        if session is None:
+            return []
+
+        entries = []
+        for number in reversed(session["segments"]):
+            entries = [
+                [seq, ts, number, offset]
+                for seq, ts, offset in self._segments[number].session_entries(session_id)
+                if before_seq is None or seq < before_seq
+            ] + entries
+            if len(entries) >= limit:
+                break
+        return entries[-limit:]
+
+    def load_messages(self, session_id, limit, before_seq=None, load_results=True):
+        """
+        Load the latest messages of a conversation.
+
+        Parameters
+        ----------
+        session_id : str
+            The conversation to load.
+        limit : int
+            Maximum number of messages to load.
+        before_seq : int, optional
+            Only load messages older than this sequence number, used for
+            paging back through the history (default is None).
+        load_results : bool, optional
+            Read the messages' DataFrames from disk; otherwise only their
+            "result_id" is set and `load_result` fetches them later
+            (default is True).
+
+        Returns
+        -------
+        list of MessageDict
+            The messages in chronological order, each with its "seq" and
+            "result_id" keys set.
+        """
+        with self._lock:
+            records = []
+            files = {}
+            try:
+                for _, _, number, offset in self._session_entries(session_id, limit, before_seq):
+                    if number not in files:
+                        files[number] = open(self._segment_file(number), "rb")
+                    files[number].seek(offset)
+                    records.append(json.loads(files[number].readline()))
+            finally:
+                for file in files.values():
+                    file.close()
+
+        messages = []
+        for record in records:
+            message = {field: record[field] for field in MESSAGE_FIELDS if field in record}
+            message["seq"] = record["seq"]
+            message["result_id"] = record.get("result_id", None)
+            message["dataframe"] = None
+            message["figure"] = None
+            message["figure_checked"] = False
+            if load_results and message["result_id"] is not None:
+                message["dataframe"] = self.load_result(message["result_id"])
+            messages.append(message)
+        return messages
+
+    def has_older_messages(self, session_id, before_seq):
+        """
+        Check whether a conversation has messages older than `before_seq`.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session is not None and session["first_seq"] < before_seq
+
+    def load_result(self, result_id):
+        """
+        Read an archived query result.
+
+        Parameters
+        ----------
+        result_id : str
+            The "result_id" of an archived message.
+
+        Returns
+        -------
+        pd.DataFrame or None
+            The result, or None if it was removed by retention.
+        """
+        try:
+            return pd.read_parquet(self._result_file(result_id))
+        except FileNotFoundError:
+            return None
+
+    def save_figure(self, result_id, figure):
+        """
+        Store the figure of an archived result next to it.
+
+        Parameters
+        ----------
+        result_id : str
+            The "result_id" of an archived message.
+        figure : go.Figure
+            The downsampled figure of the result.
+        """
+        if not os.path.exists(self._result_file(result_id)):
+            return
+        path = self._figure_file(result_id)
+        with open(path + ".tmp", "w", encoding="utf-8") as file:
+            file.write(figure.to_json())
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            self._size += os.path.getsize(path)
+
+    def load_figure(self, result_id):
+        """
+        Read the stored figure of an archived result.
+
+        Parameters
+        ----------
+        result_id : str
+            The "result_id" of an archived message.
+
+        Returns
+        -------
+        go.Figure or None
+            The figure, or None if none was stored.
+        """
+        try:
+            with open(self._figure_file(result_id), "r", encoding="utf-8") as file:
+                return pio.from_json(file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _remove_result(self, result_id):
+        for path in (self._result_file(result_id), self._figure_file(result_id)):
+            if os.path.exists(path):
+                self._size -= os.path.getsize(path)
+                os.remove(path)
+
+    def _remove_segment(self, number):
+        for path in (self._segment_file(number), self._index_file(number)):
+            if os.path.exists(path):
+                self._size -= os.path.getsize(path)
+                os.remove(path)
+
+    def compact(self):
+        """
+        Rewrite the sealed segments holding deleted records or tombstones
+        without them, merging consecutive small segments up to the segment
+        size. Segments that are large enough and hold no deleted records are
+        left untouched.
+        """
+        with self._lock:
+            # Records of a session older than its latest tombstone are dropped
+            deleted_before = {}
+            for number in sorted(self._segments):
+                deleted_before.update(self._segments[number].deleted)
+
+            group, group_lines, group_size, group_dirty = [], [], 0, False
+
+            def flush():
+                if not group or (len(group) == 1 and not group_dirty):
+                    return
+                target = self._segment_file(group[0])
+                if group_lines:
+                    index, offset = SegmentIndex(), 0
+                    for record, line in group_lines:
+                        index.add(record, offset)
+                        offset += len(line)
+                    index.bytes = offset
+                    with open(target + ".tmp", "wb") as file:
+                        file.writelines(line for _, line in group_lines)
+                    os.replace(target + ".tmp", target)
+                    index.write(self._index_file(group[0]))
+                else:
+                    self._remove_segment(group[0])
+                for number in group[1:]:
+                    self._remove_segment(number)
+
+            for number in sorted(self._segments):
+                if number == self._active:
+                    break
+                index = self._segments[number]
+                dirty = bool(index.deleted) or any(
+                    summary["first_seq"] < deleted_before.get(session_id, -1)
+                    for session_id, summary in index.sessions.items()
+                )
+                if not dirty and index.bytes >= self.segment_max_bytes * COMPACT_MIN_FILL:
+                    flush()
+                    group, group_lines, group_size, group_dirty = [], [], 0, False
+                    continue
+
+                lines = []
+                for _, record in self._read_segment(number):
+                    if record.get("deleted", False):
+                        continue
+                    if record["seq"] < deleted_before.get(record["session_id"], -1):
+                        if record.get("result_id"):
+                            self._remove_result(record["result_id"])
+                        continue
+                    lines.append((record, self._encode(record)))
+
+                size = sum(len(line) for _, line in lines)
+                if group and group_size + size > self.segment_max_bytes:
+                    flush()
+                    group, group_lines, group_size, group_dirty = [], [], 0, False
+                group.append(number)
+                group_lines.extend(lines)
+                group_size += size
+                group_dirty = group_dirty or dirty
+            flush()
+
+            # Tombstones in the active segment are kept for the next compaction
+            self._load_index()
+
+    def enforce_retention(self):
+        """
+        Remove the oldest sealed segments, with their results, until the
+        archive fits into `max_bytes`. If that is not enough, remove the
+        oldest results of the active segment, keeping its message records.
+        """
+        with self._lock:
+            removed = False
+            for number in sorted(self._segments):
+                if self._size <= self.max_bytes or number == self._active:
+                    break
+                for result_id in self._segments.pop(number).results:
+                    self._remove_result(result_id)
+                self._remove_segment(number)
+                removed = True
+            if removed:
+                self._rebuild_sessions()
+
+            for result_id in self._segments[self._active].results:
+                if self._size <= self.max_bytes:
+                    break
+                self._remove_result(result_id)
+
+
+archive = ConversationArchive(ARCHIVE_DIR)
@@ -0,0 +1,413 @@
+import numbers
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from collections import OrderedDict
+
+# Maximum number of points per trace serialised to the browser
+MAX_POINTS = 2000
+
+# Maximum number of bars shown before the remaining categories are merged
+MAX_CATEGORIES = 30
+
+# Maximum number of numeric series drawn in a single line chart
+MAX_SERIES = 5
+
+# Number of bins used for histograms
+HISTOGRAM_BINS = 50
+
+# Number of figures kept in the figure cache
+FIGURE_CACHE_SIZE = 128
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Select points of a series with the Largest-Triangle-Three-Buckets algorithm.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Sorted x values as floats.
+    y : np.ndarray
+        The y values as floats, same length as `x`.
+    threshold : int
+        Number of points to keep.
+
+    Returns
+    -------
+    np.ndarray
+        Sorted integer positions of the selected points.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    # Interior points are split into threshold - 2 buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    a = 0
+
+    for i in range(threshold - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+
+        # The average of the next bucket is the third triangle vertex
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], max(edges[i + 2], edges[i + 1] + 1)
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+
+    return selected
+
+
+def grid_bin_indices(x, y, max_points):
+    """
+    Thin out a point cloud by keeping one point per occupied grid cell.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The x values as floats.
+    y : np.ndarray
+        The y values as floats, same length as `x`.
+    max_points : int
+        Upper bound for the number of points kept.
+
+    Returns
+    -------
+    np.ndarray
+        Sorted integer positions of the kept points.
+    """
+    n = len(x)
+    if n <= max_points:
+        return np.arange(n)
+
+    cells = int(np.sqrt(max_points))
+
+    def to_bins(values):
+        low, high = values.min(), values.max()
+        if high == low:
+            return np.zeros(len(values), dtype=np.int64)
+        return ((values - low) / (high - low) * (cells - 1)).astype(np.int64)
+
+    cell_ids = to_bins(x) * cells + to_bins(y)
+    _, kept = np.unique(cell_ids, return_index=True)
+    return np.sort(kept)[:max_points]
+
+
+def coerce_columns(df):
+    """
+    Convert object columns holding numbers (e.g. `Decimal` from PostgreSQL
+    NUMERIC) or dates into numeric and datetime columns. Text columns are
+    kept as they are, even if they look numeric, like zip codes or '00123'.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The query result.
+
+    Returns
+    -------
+    pd.DataFrame
+        A copy of the result with converted columns.
+    """
+    df = df.copy()
+    for column in df.columns:
+        series = df[column]
+        if series.dtype != object:
+            continue
+        values = series.dropna()
+        if values.empty:
+            continue
+
+        if values.map(lambda value: isinstance(value, numbers.Number) and not isinstance(value, bool)).all():
+            df[column] = pd.to_numeric(series, errors="coerce")
+            continue
+
+        if values.map(lambda value: hasattr(value, "year")).all():
+            df[column] = pd.to_datetime(series, errors="coerce")
+
+    # Infinite values cannot be binned or downsampled, so they are treated as missing
+    numeric = df.select_dtypes(include="number").columns
+    df[numeric] = df[numeric].replace([np.inf, -np.inf], np.nan)
+    return df
+
+
+def is_identifier(df, column):
+    """
+    Check whether a column looks like an identifier or key by its name.
+    """
+    name = str(column).lower()
+    return name == "id" or name.endswith("_id") or name.endswith("_key")
+
+
+def is_unique_integer(df, column):
+    """
+    Check whether a column holds unique integers, like a surrogate key.
+    """
+    return pd.api.types.is_integer_dtype(df[column]) and df[column].is_unique
+
+
+def infer_chart(df):
+    """
+    Infer a chart type from the result schema without calling the LLM.
+
+    Identifier columns are never charted as measures. Unique integer columns
+    are skipped as well when other measures are available. Bar charts, and
+    line charts split by a category, prefer float measures (including
+    PostgreSQL NUMERIC), then the last numeric column.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The query result with coerced column types.
+
+    Returns
+    -------
+    dict or None
+        A chart specification with keys "kind", "x", "y" and, for long-format
+        line charts, "group", or None when the schema does not match any of
+        the known patterns.
+    """
+    if df is None or len(df) < 2:
+        return None
+
+    numeric = [
+        column for column in df.columns
+        if pd.api.types.is_numeric_dtype(df[column])
+        and not pd.api.types.is_bool_dtype(df[column])
+    ]
+    measures = [column for column in numeric if not is_identifier(df, column)]
+    non_key_measures = [column for column in measures if not is_unique_integer(df, column)]
+    if non_key_measures:
+        measures = non_key_measures
+    temporal = [
+        column for column in df.columns
+        if pd.api.types.is_datetime64_any_dtype(df[column])
+    ]
+    categorical = [
+        column for column in df.columns
+        if column not in numeric and column not in temporal
+    ]
+
+    if not measures:
+        return None
+
+    floats = [column for column in measures if pd.api.types.is_float_dtype(df[column])]
+    measure = (floats or measures)[-1]
+
+    # Long-format results, e.g. (date, region, sales), get one line per category
+    if temporal and categorical:
+        return {"kind": "line", "x": temporal[0], "y": [measure], "group": categorical[0]}
+    if temporal:
+        return {"kind": "line", "x": temporal[0], "y": measures[:MAX_SERIES]}
+    if categorical:
+        return {"kind": "bar", "x": categorical[0], "y": [measure]}
+    if len(measures) >= 2:
+        return {"kind": "scatter", "x": measures[0], "y": measures[1:2]}
+    return {"kind": "histogram", "x": measures[0], "y": []}
+
+
+def _as_float(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.astype("int64").to_numpy(dtype=float)
+    return series.to_numpy(dtype=float)
+
+
+def _downsampled_line(series, x, column, name):
+    keep = lttb_indices(_as_float(series[x]), _as_float(series[column]), MAX_POINTS)
+    series = series.iloc[keep]
+    return go.Scattergl(x=series[x], y=series[column], mode="lines", name=name)
+
+
+def _line_traces(df, x, y_columns, group=None):
+    df = df.dropna(subset=[x]).sort_values(x)
+
+    if group is None:
+        return [
+            _downsampled_line(df[[x, column]].dropna(), x, column, str(column))
+            for column in y_columns
+        ]
+
+    # One line per category for the largest MAX_SERIES categories, the rest summed
+    column = y_columns[0]
+    categories = df[group].map(str)
+    top = df[column].groupby(categories).sum().abs().nlargest(MAX_SERIES).index
+    lines = [(name, categories == name) for name in top]
+    if len(top) < categories.nunique():
+        lines.append(("Other", ~categories.isin(top)))
+
+    traces = []
+    for name, mask in lines:
+        series = df.loc[mask].groupby(x, as_index=False)[column].sum()
+        traces.append(_downsampled_line(series, x, column, name))
+    return traces
+
+
+def _bar_traces(df, x, y_columns):
+    column = y_columns[0]
+    # Categories are grouped by their text, as json columns hold unhashable dicts
+    categories = df[x].map(str) if df[x].dtype == object else df[x]
+    totals = df[column].groupby(categories, dropna=False).sum().sort_values(ascending=False)
+    if len(totals) > MAX_CATEGORIES:
+        other = totals.iloc[MAX_CATEGORIES - 1:].sum()
+        totals = totals.iloc[:MAX_CATEGORIES - 1]
+        totals = pd.concat([totals, pd.Series({"Other": other})])
+    return [go.Bar(x=totals.index.astype(str), y=totals.to_numpy(), name=str(column))]
+
+
+def _scatter_traces(df, x, y_columns):
+    column = y_columns[0]
+    points = df[[x, column]].dropna()
+    keep = grid_bin_indices(_as_float(points[x]), _as_float(points[column]), MAX_POINTS)
+    points = points.iloc[keep]
+    return [go.Scattergl(x=points[x], y=points[column], mode="markers", name=str(column))]
+
+
+def _histogram_traces(df, x, y_columns):
+    values = df[x].dropna().to_numpy(dtype=float)
+    values = values[np.isfinite(values)]
+    counts, edges = np.histogram(values, bins=HISTOGRAM_BINS)
+    centers = (edges[:-1] + edges[1:]) / 2
+    return [go.Bar(x=centers, y=counts, width=np.diff(edges), name=str(x))]
+
+
+CHART_BUILDERS = {
+    "line": _line_traces,
+    "bar": _bar_traces,
+    "scatter": _scatter_traces,
+    "histogram": _histogram_traces,
+}
+
+
+def build_figure(df, spec):
+    """
+    Build a plotly figure for a chart specification, aggregating or
+    downsampling large series so that at most `MAX_POINTS` points per
+    trace are sent to the browser.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The query result with coerced column types.
+    spec : dict
+        The chart specification returned by `infer_chart`.
+
+    Returns
+    -------
+    go.Figure
+        The plotly figure.
+    """
+    if spec.get("group") is not None:
+        traces = _line_traces(df, spec["x"], spec["y"], group=spec["group"])
+    else:
+        traces = CHART_BUILDERS[spec["kind"]](df, spec["x"], spec["y"])
+    figure = go.Figure(data=traces)
+    if spec["kind"] == "histogram":
+        yaxis_title = "count"
+    else:
+        yaxis_title = str(spec["y"][0]) if len(spec["y"]) == 1 else None
+
+    figure.update_layout(
+        xaxis_title=str(spec["x"]),
+        yaxis_title=yaxis_title,
+        showlegend=len(traces) > 1 or spec.get("group") is not None,
+        margin={"l": 40, "r": 20, "t": 20, "b": 40},
+    )
+    return figure
+
+
+class FigureCache:
+    """
+    Thread-safe in-process LRU cache of figures keyed by SQL query and result
+    shape. Figures of archived results are also persisted by the archive.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of figures kept.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(sql, df):
+        digest = hashlib.sha1((sql or "").encode("utf-8"))
+        digest.update(repr((df.shape, list(df.columns), [str(dtype) for dtype in df.dtypes])).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._figures:
+                return None
+            self._figures.move_to_end(key)
+            return self._figures[key]
+
+    def put(self, key, figure):
+        with self._lock:
+            self._figures[key] = figure
+            self._figures.move_to_end(key)
+            while len(self._figures) > self.maxsize:
+                self._figures.popitem(last=False)
+
+
+figure_cache = FigureCache(FIGURE_CACHE_SIZE)
+
+
+def create_figure(df, sql=None):
+    """
+    Create a figure for a query result, with the chart type inferred from the
+    result schema. Failures are reported and result in no figure, so that a
+    chart never fails the answer it belongs to.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The query result.
+    sql : str, optional
+        The SQL query that produced the result. Together with the result
+        shape it forms the cache key; without it the figure is not cached
+        (default is None).
+
+    Returns
+    -------
+    go.Figure or None
+        The figure, or None if the result should not or could not be charted.
+    """
+    if df is None or df.empty:
+        return None
+
+    try:
+        key = FigureCache.key(sql, df) if sql else None
+        figure = figure_cache.get(key) if key else None
+        if figure is not None:
+            return figure
+
+        coerced = coerce_columns(df)
+        spec = infer_chart(coerced)
+        if spec is None:
+            return None
+
+        figure = build_figure(coerced, spec)
+        if key:
+            figure_cache.put(key, figure)
+        return figure
+    except Exception as exc:
+        print(f"Failed to create a chart: {exc!r}")
+        return None
@@ -3,6 +3,7 @@ from dotenv import load_dotenv
 from openai import AzureOpenAI
 from azure.identity import DefaultAzureCredential
 from azure.identity import get_bearer_token_provider
+from utils.llm_scheduler import Priority, estimate_tokens, llm_scheduler
 
 load_dotenv('.env', override=True)
 
@@ -11,15 +12,22 @@ AZURE_OPENAI_MODEL_DEPLOYMENT = os.getenv("AZURE_OPENAI_MODEL_DEPLOYMENT")
 with open("utils/prompt/sqlcheck.txt", "r") as file:
     SQL_CHECK_PROMPT = file.read()
 
-token_provider = get_bearer_token_provider(
-    DefaultAzureCredential(), 
-    "https://cognitiveservices.azure.com/.default"
-)
+# An API key, e.g. for a local fake endpoint, replaces Microsoft Entra ID authentication
+if os.getenv("AZURE_OPENAI_API_KEY"):
+    credentials = {"api_key": os.getenv("AZURE_OPENAI_API_KEY")}
+else:
+    credentials = {
+        "azure_ad_token_provider": get_bearer_token_provider(
+            DefaultAzureCredential(), 
+            "https://cognitiveservices.azure.com/.default"
+        )
+    }
 
 openai_client = AzureOpenAI(
     api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    azure_ad_token_provider=token_provider
+    max_retries=0,  # retries are handled by llm_scheduler
+    **credentials
 )
 
 
@@ -42,39 +50,57 @@ def find_sql(text):
         {"role": "user", "content": f"<input>{text}</input>"},
     ]
 
-    response = openai_client.chat.completions.create(
-        messages=turn_message,
-        max_tokens=2,
-        temperature=0.0,
-        top_p=1.0,
-        model=AZURE_OPENAI_MODEL_DEPLOYMENT,
-        stream=False,
-        stop=["\n"],
+    response = llm_scheduler.call(
+        lambda: openai_client.chat.completions.create(
+            messages=turn_message,
+            max_tokens=2,
+            temperature=0.0,
+            top_p=1.0,
+            model=AZURE_OPENAI_MODEL_DEPLOYMENT,
+            stream=False,
+            stop=["\n"],
+        ),
+        priority=Priority.INTERACTIVE,
+        tokens=estimate_tokens(turn_message, max_tokens=2),
     )
     result = response.choices[0].message.content.strip().lower()
     return result == "true"
 
 
-def generate_sql(messages):
+def generate_sql(messages, priority=Priority.INTERACTIVE):
     """
     Generate an SQL query based on input messages using the Azure OpenAI client.
 
+    The scheduler slot is released once the stream is opened, so throttling
+    is only detected when the request is made, not while consuming the stream.
+    The stream ends with a chunk without choices carrying the token usage,
+    which is used to settle the scheduler's token bucket.
+
     Parameters
     ----------
     messages : list
         A list of message dictionaries to provide context for the prompt.
+    priority : Priority, optional
+        The scheduler lane for the request (default is Priority.INTERACTIVE).
 
     Returns
     -------
-    openai.ChatCompletion.stream
-        An iterable stream of the chat completion responses.
+    generator
+        An iterable stream of the chat completion chunks.
     """
-    return openai_client.chat.completions.create(
-        messages=messages,
-        max_tokens=256,
-        temperature=0.75,
-        top_p=1.0,
-        model=AZURE_OPENAI_MODEL_DEPLOYMENT,
-        stream=True,
+    tokens = estimate_tokens(messages, max_tokens=256)
+    stream = llm_scheduler.call(
+        lambda: openai_client.chat.completions.create(
+            messages=messages,
+            max_tokens=256,
+            temperature=0.75,
+            top_p=1.0,
+            model=AZURE_OPENAI_MODEL_DEPLOYMENT,
+            stream=True,
+            stream_options={"include_usage": True},
+        ),
+        priority=priority,
+        tokens=tokens,
     )
+    return llm_scheduler.settle_stream(stream, tokens)
 
@@ -0,0 +1,438 @@
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+from enum import IntEnum
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dotenv import load_dotenv
+
+load_dotenv('.env', override=True)
+
+
+class Priority(IntEnum):
+    """
+    Scheduling lanes for LLM calls. Lower values are served first.
+    """
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+# Lane used by calls that do not choose one explicitly, set with `priority_lane`
+current_priority = ContextVar("current_priority", default=Priority.INTERACTIVE)
+
+
+@contextmanager
+def priority_lane(priority):
+    """
+    Run the calls made inside the block, in the current thread or task, in
+    the given scheduler lane.
+
+    Parameters
+    ----------
+    priority : Priority
+        The lane to use.
+    """
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `capacity` units per minute.
+
+    Parameters
+    ----------
+    capacity : int
+        Maximum number of units available per minute.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        """
+        Return the number of seconds until `amount` units are available.
+
+        Requests larger than the bucket capacity are clamped to the capacity,
+        so that they wait for a full bucket instead of waiting forever.
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        """
+        Remove `amount` units from the bucket. The balance may go negative when
+        correcting an estimate after the fact, which delays later requests.
+        """
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        """
+        Return `amount` units to the bucket, up to its capacity.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    AIMD concurrency limit: grows by roughly one slot per fully successful
+    window and is halved whenever the service answers with HTTP 429.
+
+    Parameters
+    ----------
+    initial : int
+        Starting number of concurrent calls.
+    minimum : int
+        Lower bound for the limit.
+    maximum : int
+        Upper bound for the limit.
+    backoff_ratio : float, optional
+        Multiplicative decrease factor applied on throttling (default is 0.5).
+    """
+
+    def __init__(self, initial, minimum, maximum, backoff_ratio=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff_ratio = backoff_ratio
+        self.limit = float(min(max(initial, minimum), maximum))
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_throttle(self):
+        self.limit = max(self.minimum, self.limit * self.backoff_ratio)
+
+    @property
+    def value(self):
+        return int(self.limit)
+
+
+class QueueWaitMetric:
+    """
+    Rolling record of how long calls waited in the scheduler queue.
+
+    Parameters
+    ----------
+    window : int, optional
+        Number of most recent samples kept for percentiles (default is 1000).
+    """
+
+    def __init__(self, window=1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        """
+        Return the metric as a dictionary with count, mean, p50, p95 and max
+        queue wait times in seconds.
+        """
+        ordered = sorted(self.samples)
+
+        def percentile(q):
+            if not ordered:
+                return 0.0
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "max": self.max,
+        }
+
+
+def is_rate_limited(exc):
+    """
+    Check whether an exception represents an HTTP 429 response.
+    """
+    return getattr(exc, "status_code", None) == 429
+
+
+def is_retryable(exc):
+    """
+    Check whether an exception is a transient failure worth retrying:
+    throttling, server errors, timeouts and connection errors.
+    """
+    status_code = getattr(exc, "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return type(exc).__name__ in ("APIConnectionError", "APITimeoutError") \
+        or isinstance(exc, (ConnectionError, TimeoutError))
+
+
+def retry_after(exc):
+    """
+    Read the server-suggested delay in seconds from a failed response, if any.
+    """
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for header in ("retry-after-ms", "retry-after"):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            seconds = float(value)
+        except ValueError:
+            continue
+        return seconds / 1000.0 if header == "retry-after-ms" else seconds
+    return None
+
+
+def estimate_tokens(messages, max_tokens=0):
+    """
+    Roughly estimate the number of tokens a chat completion request will use.
+
+    Parameters
+    ----------
+    messages : list
+        A list of message dictionaries sent as the prompt.
+    max_tokens : int, optional
+        The completion budget requested from the model (default is 0).
+
+    Returns
+    -------
+    int
+        The estimated prompt plus completion token count.
+    """
+    characters = sum(len(str(message.get("content") or "")) for message in messages)
+    return characters // 4 + 4 * len(messages) + (max_tokens or 0)
+
+
+class LLMScheduler:
+    """
+    Client-side scheduler shared by every LLM call in the application.
+
+    Calls are admitted in priority order once both the request and token
+    buckets have capacity and the adaptive concurrency limit allows another
+    call in flight. Retryable failures are retried with full-jitter
+    exponential backoff, honouring the `Retry-After` header when present.
+
+    Parameters
+    ----------
+    requests_per_minute : int
+        Request-per-minute quota of the deployment.
+    tokens_per_minute : int
+        Token-per-minute quota of the deployment.
+    max_concurrency : int
+        Upper bound for the adaptive concurrency limit.
+    min_concurrency : int, optional
+        Lower bound for the adaptive concurrency limit (default is 1).
+    max_retries : int, optional
+        Number of retries after the first attempt (default is 5).
+    base_delay : float, optional
+        Base backoff delay in seconds (default is 0.5).
+    max_delay : float, optional
+        Maximum backoff delay in seconds (default is 30.0).
+    """
+
+    def __init__(
+            self,
+            requests_per_minute,
+            tokens_per_minute,
+            max_concurrency,
+            min_concurrency=1,
+            max_retries=5,
+            base_delay=0.5,
+            max_delay=30.0
+        ):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrencyLimit(
+            initial=max(min_concurrency, max_concurrency // 2),
+            minimum=min_concurrency,
+            maximum=max_concurrency
+        )
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue_wait = QueueWaitMetric()
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+
+    def _acquire(self, ticket, tokens):
+        """
+        Block until the call is at the head of the queue and can be admitted.
+        Returns the number of seconds spent waiting.
+        """
+        started_at = time.monotonic()
+
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if self._waiting[0] == ticket and self._in_flight < self.concurrency.value:
+                        timeout = max(
+                            self.request_bucket.wait_time(1),
+                            self.token_bucket.wait_time(tokens)
+                        )
+                        if timeout == 0.0:
+                            break
+                    self._condition.wait(timeout)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(tokens)
+            self._in_flight += 1
+
+        return time.monotonic() - started_at
+
+    def _release(self, outcome):
+        """
+        Free a concurrency slot. The limit grows on "success", shrinks on
+        "throttled" and is left unchanged on any other failure.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if outcome == "throttled":
+                self.concurrency.on_throttle()
+            elif outcome == "success":
+                self.concurrency.on_success()
+            self._condition.notify_all()
+
+    def settle_tokens(self, estimated, usage):
+        """
+        Correct the token bucket with the usage reported by the service.
+
+        Parameters
+        ----------
+        estimated : int
+            The number of tokens consumed when the call was admitted.
+        usage : openai.types.CompletionUsage or None
+            The usage reported in the response; ignored when None.
+        """
+        actual = getattr(usage, "total_tokens", None)
+        if actual is None:
+            return
+        with self._condition:
+            if actual > estimated:
+                self.token_bucket.consume(actual - estimated)
+            else:
+                self.token_bucket.refund(estimated - actual)
+            self._condition.notify_all()
+
+    def settle_stream(self, stream, estimated):
+        """
+        Pass through the chunks of a streamed completion and settle the token
+        bucket with the usage chunk sent at the end of the stream.
+
+        Parameters
+        ----------
+        stream : openai.Stream
+            A stream created with `stream_options={"include_usage": True}`.
+        estimated : int
+            The number of tokens consumed when the call was admitted.
+
+        Yields
+        ------
+        openai.types.chat.ChatCompletionChunk
+            The chunks of the stream.
+        """
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                self.settle_tokens(estimated, chunk.usage)
+            yield chunk
+
+    def _backoff(self, attempt, exc):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        suggested = retry_after(exc)
+        if suggested is not None:
+            delay = max(delay, min(self.max_delay, suggested))
+        return delay
+
+    def call(self, fn, priority=Priority.INTERACTIVE, tokens=1):
+        """
+        Run `fn` under the scheduler's rate and concurrency limits.
+
+        A retried call keeps its original place in the queue, and its queue
+        wait time is recorded once, summed over all attempts.
+
+        Parameters
+        ----------
+        fn : callable
+            A zero-argument callable performing the LLM request.
+        priority : Priority, optional
+            The lane to queue the call in (default is Priority.INTERACTIVE).
+        tokens : int, optional
+            Estimated number of tokens the call consumes (default is 1).
+
+        Returns
+        -------
+        Any
+            The return value of `fn`.
+        """
+        ticket = (int(priority), next(self._sequence))
+        waited = 0.0
+        attempt = 0
+        try:
+            while True:
+                waited += self._acquire(ticket, tokens)
+                try:
+                    result = fn()
+                except Exception as exc:
+                    self._release("throttled" if is_rate_limited(exc) else "failed")
+                    if attempt >= self.max_retries or not is_retryable(exc):
+                        raise
+                    time.sleep(self._backoff(attempt, exc))
+                    attempt += 1
+                    continue
+
+                self._release("success")
+                self.settle_tokens(tokens, getattr(result, "usage", None))
+                return result
+        finally:
+            self.queue_wait.observe(waited)
+
+    def metrics(self):
+        """
+        Return the current scheduler state and queue wait time metric.
+        """
+        with self._condition:
+            return {
+                "queue_wait_seconds": self.queue_wait.snapshot(),
+                "queued": len(self._waiting),
+                "in_flight": self._in_flight,
+                "concurrency_limit": self.concurrency.value,
+            }
+
+
+llm_scheduler = LLMScheduler(
+    requests_per_minute=int(os.getenv("AZURE_OPENAI_RPM_LIMIT", "60")),
+    tokens_per_minute=int(os.getenv("AZURE_OPENAI_TPM_LIMIT", "60000")),
+    max_concurrency=int(os.getenv("AZURE_OPENAI_MAX_CONCURRENCY", "8")),
+    max_retries=int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "5")),
+)
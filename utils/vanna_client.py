@@ -6,23 +6,34 @@ from vanna.qdrant import Qdrant_VectorStore
 from qdrant_client import QdrantClient
 from azure.identity import DefaultAzureCredential
 from azure.identity import get_bearer_token_provider
+from utils.llm_scheduler import current_priority, estimate_tokens, llm_scheduler
 
 load_dotenv('.env', override=True)
 
+# Completion allowance added to the token estimate of Vanna's LLM calls
+VANNA_COMPLETION_TOKENS = 1000
+
 qdrant_client = QdrantClient(
     url=os.getenv('QDRANT_API_URL'),
     api_key=os.getenv('QDRANT__SERVICE__API_KEY')
 )
 
-token_provider = get_bearer_token_provider(
-    DefaultAzureCredential(), 
-    "https://cognitiveservices.azure.com/.default"
-)
+# An API key, e.g. for a local fake endpoint, replaces Microsoft Entra ID authentication
+if os.getenv("AZURE_OPENAI_API_KEY"):
+    credentials = {"api_key": os.getenv("AZURE_OPENAI_API_KEY")}
+else:
+    credentials = {
+        "azure_ad_token_provider": get_bearer_token_provider(
+            DefaultAzureCredential(), 
+            "https://cognitiveservices.azure.com/.default"
+        )
+    }
 
 openai_client = AzureOpenAI(
     api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    azure_ad_token_provider=token_provider
+    max_retries=0,  # retries are handled by llm_scheduler
+    **credentials
 )
 
 class MyVanna(Qdrant_VectorStore, OpenAI_Chat):
@@ -42,6 +53,40 @@ class MyVanna(Qdrant_VectorStore, OpenAI_Chat):
             config={"model": openai_model}
         ) 
 
+    def submit_prompt(self, prompt, **kwargs):
+        """
+        Submit a prompt to the LLM through the shared `llm_scheduler`, in
+        the lane selected with `priority_lane` (interactive by default).
+
+        The client is called directly instead of `OpenAI_Chat.submit_prompt`,
+        so that the scheduler can settle its token bucket with the usage
+        reported in the response.
+
+        Parameters
+        ----------
+        prompt : list
+            A list of message dictionaries built by Vanna.
+
+        Returns
+        -------
+        str
+            The LLM response text.
+        """
+        if not prompt:
+            raise Exception("Prompt is None or empty")
+
+        response = llm_scheduler.call(
+            lambda: self.client.chat.completions.create(
+                model=kwargs.get("model", None) or self.config["model"],
+                messages=prompt,
+                stop=None,
+                temperature=self.temperature,
+            ),
+            priority=current_priority.get(),
+            tokens=estimate_tokens(prompt, max_tokens=VANNA_COMPLETION_TOKENS),
+        )
+        return response.choices[0].message.content
+
 vn = MyVanna(
     qdrant_client=qdrant_client,
     openai_client=openai_client,